@@ -7,5 +7,5 @@ setup(
     author_email='benjamin.stevens.au@gmail.com',
     description='Easily manage qemu-based virtual machines and virtual bridges connecting them',
     packages=find_packages(),
-    install_requires=["scapy", "pexpect", "backoff"],
+    install_requires=["pexpect", "pyroute2"],
 )
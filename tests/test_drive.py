@@ -0,0 +1,36 @@
+import subprocess
+
+import pytest
+
+from weaver import Drive as drive_module
+from weaver.Drive import Drive
+
+
+def failing_run(stderr):
+    def run(argv):
+        raise subprocess.CalledProcessError(1, argv, stderr=stderr)
+    return run
+
+
+@pytest.mark.parametrize("stderr", [
+    b"qemu-img: Could not apply snapshot 'preboot': Can't find snapshot\n",
+    b"qemu-img: Could not apply snapshot 'preboot': -2 (No such file or directory)\n",
+])
+def test_apply_missing_snapshot(monkeypatch, stderr):
+    monkeypatch.setattr(drive_module, "_run", failing_run(stderr))
+    with pytest.raises(Drive.SnapshotNotFound):
+        Drive("disk.qcow2").apply_snapshot("preboot")
+
+
+def test_apply_locked_image(monkeypatch):
+    monkeypatch.setattr(drive_module, "_run", failing_run(
+        b'qemu-img: Could not open \'disk.qcow2\': Failed to get "write" lock\n'))
+    with pytest.raises(Drive.ImageLocked):
+        Drive("disk.qcow2").apply_snapshot("preboot")
+
+
+def test_apply_other_failure_is_reraised(monkeypatch):
+    monkeypatch.setattr(drive_module, "_run", failing_run(
+        b"qemu-img: Could not open 'disk.qcow2': No such file or directory\n"))
+    with pytest.raises(subprocess.CalledProcessError):
+        Drive("disk.qcow2").apply_snapshot("preboot")
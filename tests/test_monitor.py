@@ -0,0 +1,66 @@
+import socket
+
+import pexpect
+import pytest
+
+from weaver.Monitor import MonitorChannel
+
+
+@pytest.fixture
+def channel():
+    ours, qemu = socket.socketpair()
+    yield MonitorChannel(ours, timeout=1, bufsize=16), qemu
+    qemu.close()
+
+
+def test_expect_exact_sets_before(channel):
+    ch, qemu = channel
+    qemu.sendall(b"QEMU monitor\r\n(qemu) ")
+    assert ch.expect_exact("(qemu)") == 0
+    assert ch.before == "QEMU monitor\r\n"
+
+
+def test_sendline(channel):
+    ch, qemu = channel
+    ch.sendline("info status")
+    assert qemu.recv(64) == b"info status\n"
+
+
+def test_consecutive_prompts_and_buffer_growth(channel):
+    ch, qemu = channel
+    qemu.sendall(b" info x\r\n" + b"y" * 100 + b"\r\n(qem")
+    qemu.sendall(b"u) stop\r\n(qemu) ")
+    ch.expect_exact("(qemu)")
+    assert ch.before.splitlines()[1:] == ["y" * 100]
+    ch.expect_exact("(qemu)")
+    assert ch.before == " stop\r\n"
+
+
+def test_earliest_pattern_wins(channel):
+    ch, qemu = channel
+    qemu.sendall(b"abc bar foo")
+    assert ch.expect_exact(["foo", "bar"]) == 1
+    assert ch.before == "abc "
+
+
+def test_buffered_data_searched_again_after_timeout(channel):
+    ch, qemu = channel
+    qemu.sendall(b"hello bar world (qemu) ")
+    with pytest.raises(pexpect.TIMEOUT):
+        ch.expect_exact("foo", timeout=0.1)
+    assert ch.expect_exact("bar", timeout=0.1) == 0
+    assert ch.before == "hello "
+
+
+def test_timeout_in_pattern_list(channel):
+    ch, qemu = channel
+    assert ch.expect_exact(["(qemu)", pexpect.TIMEOUT], timeout=0) == 1
+
+
+def test_eof(channel):
+    ch, qemu = channel
+    qemu.sendall(b"partial")
+    qemu.close()
+    with pytest.raises(pexpect.EOF):
+        ch.expect_exact("(qemu)")
+    assert ch.before == "partial"
@@ -0,0 +1,122 @@
+import socket
+import struct
+
+import pytest
+
+from weaver.Network import DHCP_MAGIC_COOKIE, dhcp_filter, parse_dhcp_ack
+
+MAC = "52:54:00:12:34:56"
+YIADDR = "10.0.0.42"
+
+
+def dhcp_frame(message_type, options=None, dst=MAC, sport=67, dport=68,
+               frag=0):
+    """
+    An ethernet frame carrying a DHCP reply sent from the server port
+    """
+    if options is None:
+        options = bytes([53, 1, message_type, 54, 4]) + socket.inet_aton("10.0.0.1") + b"\xff"
+    bootp = bytearray(236)
+    bootp[0] = 2
+    bootp[16:20] = socket.inet_aton(YIADDR)
+    payload = bytes(bootp) + DHCP_MAGIC_COOKIE + options
+    udp = struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(udp), 0, frag, 64,
+                     socket.IPPROTO_UDP, 0, socket.inet_aton("10.0.0.1"),
+                     socket.inet_aton(YIADDR)) + udp
+    return bytes.fromhex(dst.replace(":", "")) + bytes(6) + b"\x08\x00" + ip
+
+
+def run_filter(program, frame):
+    """
+    Interprets the few classic BPF instructions dhcp_filter uses
+    """
+    insns = [struct.unpack("HBBI", program[i:i + 8])
+             for i in range(0, len(program), 8)]
+    a = x = pc = 0
+    while True:
+        code, jt, jf, k = insns[pc]
+        pc += 1
+        if code == 0x20:
+            a = int.from_bytes(frame[k:k + 4], "big")
+        elif code == 0x28:
+            a = int.from_bytes(frame[k:k + 2], "big")
+        elif code == 0x30:
+            a = frame[k]
+        elif code == 0x48:
+            a = int.from_bytes(frame[x + k:x + k + 2], "big")
+        elif code == 0xb1:
+            x = 4 * (frame[k] & 0xf)
+        elif code == 0x15:
+            pc += jt if a == k else jf
+        elif code == 0x45:
+            pc += jt if a & k else jf
+        elif code == 0x06:
+            return k
+        else:
+            raise AssertionError("unexpected opcode {:#x}".format(code))
+
+
+def test_filter_layout():
+    program = dhcp_filter(MAC)
+    assert len(program) == 17 * 8
+    insns = [struct.unpack("HBBI", program[i:i + 8])
+             for i in range(0, len(program), 8)]
+    accept, drop = len(insns) - 2, len(insns) - 1
+    assert insns[accept] == (0x06, 0, 0, 0x40000)
+    assert insns[drop] == (0x06, 0, 0, 0)
+    # Every jump either falls through or lands on accept or drop
+    for pc, (code, jt, jf, k) in enumerate(insns):
+        if code in (0x15, 0x45):
+            for offset in (jt, jf):
+                assert offset == 0 or pc + 1 + offset in (accept, drop)
+    # First compare is the top four bytes of the mac
+    assert insns[1][3] == 0x52540012
+    assert insns[3][3] == 0x3456
+
+
+@pytest.mark.parametrize("frame, accepted", [
+    (dhcp_frame(5), True),
+    (dhcp_frame(5, sport=68, dport=67), True),
+    (dhcp_frame(5, dst="52:54:00:12:34:57"), False),
+    (dhcp_frame(5, sport=53, dport=53), False),
+    (dhcp_frame(5, frag=1), False),
+])
+def test_filter_matches(frame, accepted):
+    assert (run_filter(dhcp_filter(MAC), frame) != 0) == accepted
+
+
+def test_parse_ack():
+    assert parse_dhcp_ack(dhcp_frame(5)) == YIADDR
+
+
+def test_parse_ack_after_pad_and_other_options():
+    options = b"\x00\x00" + bytes([51, 4, 0, 0, 14, 16, 53, 1, 5, 255])
+    assert parse_dhcp_ack(dhcp_frame(5, options)) == YIADDR
+
+
+def test_parse_offer():
+    assert parse_dhcp_ack(dhcp_frame(2)) is None
+
+
+@pytest.mark.parametrize("options", [
+    b"",
+    b"\xff",
+    bytes([53]),
+    bytes([53, 1]),
+    bytes([54, 200, 1, 2]),
+])
+def test_parse_short_options(options):
+    assert parse_dhcp_ack(dhcp_frame(5, options)) is None
+
+
+def test_parse_without_magic_cookie():
+    frame = bytearray(dhcp_frame(5))
+    frame[14 + 20 + 8 + 236] = 0
+    assert parse_dhcp_ack(bytes(frame)) is None
+
+
+def test_parse_truncated_frame():
+    assert parse_dhcp_ack(dhcp_frame(5)[:60]) is None
+    with pytest.raises(IndexError):
+        parse_dhcp_ack(dhcp_frame(5)[:14])
@@ -0,0 +1,159 @@
+import queue
+
+import pytest
+
+from weaver.Pool import POOL_SNAPSHOT, MachinePool
+
+
+class FakeMachine():
+    def __init__(self, fail_on=()):
+        self.fail_on = fail_on
+        self.calls = []
+        self.stopped = False
+        self.cleaned_up = False
+
+    def __call(self, name, *args):
+        self.calls += [(name,) + args]
+        if name in self.fail_on:
+            raise RuntimeError("{} failed".format(name))
+
+    def start(self):
+        self.__call("start")
+        return self
+
+    def take_snapshot(self, name, external=False):
+        self.__call("take_snapshot", name, external)
+
+    def goto_snapshot(self, name):
+        self.__call("goto_snapshot", name)
+
+    def monitor_command(self, *commands):
+        self.__call("monitor_command", *commands)
+        return [[] for _ in commands]
+
+    def stop(self):
+        self.stopped = True
+        self.__call("stop")
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+class Factory():
+    """
+    Hands out FakeMachines, the nth failing in the ways listed in plan[n]
+    """
+
+    def __init__(self, *plan):
+        self.plan = list(plan)
+        self.made = []
+
+    def __call__(self):
+        fail_on = self.plan.pop(0) if self.plan else ()
+        if fail_on == "factory":
+            raise ValueError("factory failed")
+        m = FakeMachine(fail_on)
+        self.made += [m]
+        return m
+
+
+def test_acquire_returns_parked_machine():
+    factory = Factory()
+    with MachinePool(factory, size=1, external=True) as pool:
+        m = pool.acquire(timeout=1)
+        assert m.calls == [("start",),
+                           ("take_snapshot", POOL_SNAPSHOT, True),
+                           ("monitor_command", "stop"),
+                           ("goto_snapshot", POOL_SNAPSHOT)]
+    assert m.stopped and m.cleaned_up
+
+
+def test_pool_never_starts_more_than_size():
+    factory = Factory()
+    with MachinePool(factory, size=2) as pool:
+        machines = {pool.acquire(timeout=1), pool.acquire(timeout=1)}
+        with pytest.raises(queue.Empty):
+            pool.acquire(timeout=0.05)
+        assert len(factory.made) == 2
+        assert set(factory.made) == machines
+
+
+def test_release_reuses_machine():
+    factory = Factory()
+    with MachinePool(factory, size=1) as pool:
+        m = pool.acquire(timeout=1)
+        pool.release(m)
+        assert m.calls[-1] == ("monitor_command", "stop")
+        assert pool.acquire(timeout=1) is m
+        assert len(factory.made) == 1
+
+
+def test_release_discards_machine_that_cannot_pause():
+    factory = Factory()
+    with MachinePool(factory, size=1) as pool:
+        m = pool.acquire(timeout=1)
+        m.fail_on = ("monitor_command",)
+        pool.release(m)
+        assert m.stopped and m.cleaned_up
+        assert pool.acquire(timeout=1) is not m
+
+
+def test_discard_replaces_machine():
+    factory = Factory()
+    with MachinePool(factory, size=1) as pool:
+        m = pool.acquire(timeout=1)
+        pool.discard(m)
+        assert m.stopped and m.cleaned_up
+        replacement = pool.acquire(timeout=1)
+        assert replacement is not m
+        assert len(factory.made) == 2
+
+
+def test_factory_error_is_raised_by_acquire_and_retried():
+    factory = Factory("factory")
+    with MachinePool(factory, size=1) as pool:
+        with pytest.raises(ValueError):
+            pool.acquire(timeout=1)
+        m = pool.acquire(timeout=1)
+        assert len(factory.made) == 1
+        assert m is factory.made[0]
+
+
+def test_failed_start_is_disposed():
+    factory = Factory(("take_snapshot",))
+    with MachinePool(factory, size=1) as pool:
+        with pytest.raises(RuntimeError):
+            pool.acquire(timeout=1)
+        failed = factory.made[0]
+        assert failed.stopped and failed.cleaned_up
+        assert pool.acquire(timeout=1) is factory.made[1]
+
+
+def test_failed_stop_still_cleans_up():
+    factory = Factory(("take_snapshot", "stop"))
+    with MachinePool(factory, size=1) as pool:
+        with pytest.raises(RuntimeError):
+            pool.acquire(timeout=1)
+        assert factory.made[0].cleaned_up
+
+
+def test_failed_goto_snapshot_discards_machine():
+    factory = Factory(("goto_snapshot",))
+    with MachinePool(factory, size=1) as pool:
+        with pytest.raises(RuntimeError):
+            pool.acquire(timeout=1)
+        failed = factory.made[0]
+        assert failed.stopped and failed.cleaned_up
+        assert pool.acquire(timeout=1) is factory.made[1]
+
+
+def test_close_stops_parked_and_acquired_machines():
+    factory = Factory()
+    pool = MachinePool(factory, size=2)
+    acquired = pool.acquire(timeout=1)
+    parked = pool.acquire(timeout=1)
+    pool.release(parked)
+    pool.close()
+    for m in (acquired, parked):
+        assert m.stopped and m.cleaned_up
+    assert len(factory.made) == 2
@@ -3,9 +3,19 @@ Handles the creation of a '-drive' parameter to qemu, including snapshots and
 creating temporary disks as layers.
 """
 
-import tempfile
 import os
+import json
 import subprocess
+import uuid
+
+
+def _run(argv):
+    """
+    Runs a command without a shell, raising CalledProcessError (with its stderr
+    attached) as soon as it fails rather than carrying on regardless
+    """
+    return subprocess.run(argv, check=True, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE)
 
 
 class Drive():
@@ -15,12 +25,22 @@ class Drive():
     back disk changes for tests.
     """
 
-    def __init__(self, file, interface="ide", media="disk", index=None):
+    def __init__(self, file, interface="ide", media="disk", index=None, drive_id=None):
         self.backing_file = file
         self.interface = interface
         self.media = media
         self.__layers = [file]
         self.index = index
+        self.drive_id = drive_id
+        self.__snapshots = None
+
+    @property
+    def layers(self):
+        """
+        The qcow2 paths making up this drive, from the backing file up to the
+        top layer
+        """
+        return list(self.__layers)
 
     def create_disk_layer(self, machine_instance_path):
         """
@@ -28,23 +48,95 @@ class Drive():
         to the top of the stack
         """
         current_layer = self.__layers[-1]
-        (fd, name) = tempfile.mkstemp(suffix=".qcow2",
-                                      prefix="drive_", dir=machine_instance_path)
-        os.close(fd)
-        cmd_string = "qemu-img create -b {} -f qcow2 {}".format(
-            current_layer, name)
-        os.system(cmd_string)
+        # The instance path is private to the machine, and qemu-img creates the
+        # file itself, so a unique name is all that's needed
+        name = os.path.join(machine_instance_path,
+                            "drive_{}.qcow2".format(uuid.uuid4().hex))
+        _run(["qemu-img", "create", "-b", current_layer, "-F", "qcow2",
+              "-f", "qcow2", name])
         self.__layers.append(name)
+        self.__snapshots = None
         return name
 
+    def add_disk_layer(self, name):
+        """
+        Puts a qcow2 that something else (e.g. a running qemu) has already
+        created on top of the stack
+        """
+        self.__layers.append(name)
+        self.__snapshots = None
+        return name
+
+    def revert_to_layer(self, name):
+        """
+        Removes every layer above the one provided from the path stack
+        """
+        index = self.__layers.index(name)
+        removed = self.__layers[index + 1:]
+        del self.__layers[index + 1:]
+        self.__snapshots = None
+        return removed
+
     def delete_disk_layer(self):
         """
         Removes the top layer qcow2 path from the path stack
         """
         if len(self.__layers) > 1:
+            self.__snapshots = None
             return self.__layers.pop()
         return None
 
+    def apply_snapshot(self, name):
+        """
+        Reverts the backing file to the snapshot with the name provided.
+        Raises SnapshotNotFound if there isn't one by that name
+        """
+        self.__snapshot("-a", name)
+
+    def create_snapshot(self, name):
+        """
+        Takes a snapshot of the backing file with the name provided
+        """
+        self.__snapshot("-c", name)
+        self.__snapshots = None
+
+    class ImageLocked(Exception):
+        """
+        Raised when the backing file can't be written because a running qemu
+        holds a lock on it, e.g. as the backing file of another Machine
+        """
+        pass
+
+    class SnapshotNotFound(Exception):
+        """
+        Raised when applying a snapshot that the backing file doesn't have
+        """
+        pass
+
+    def __snapshot(self, flag, name):
+        try:
+            _run(["qemu-img", "snapshot", flag, name, self.backing_file])
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr.decode(errors="replace")
+            if '"write" lock' in stderr:
+                raise Drive.ImageLocked(
+                    "{} is in use by another qemu: {}".format(
+                        self.backing_file, stderr.strip())) from e
+            # Older qemu-img only gives the errno for a missing snapshot
+            if "Could not apply snapshot" in stderr and (
+                    "Can't find snapshot" in stderr or
+                    "No such file or directory" in stderr):
+                raise Drive.SnapshotNotFound(
+                    "{} has no snapshot {}".format(self.backing_file, name)) from e
+            raise
+
+    def invalidate_snapshots(self):
+        """
+        Forgets the cached snapshot list, for when the top layer qcow2 has been
+        changed behind our back (e.g. by savevm in a running qemu)
+        """
+        self.__snapshots = None
+
     def to_drive_string(self):
         """
         Provides a string that can be passed as an argument to a -drive argument
@@ -53,6 +145,8 @@ class Drive():
         strings = []
         if self.interface is not None:
             strings += ["if={}".format(self.interface)]
+        if self.drive_id is not None:
+            strings += ["id={}".format(self.drive_id)]
         strings += ["file={}".format(self.__layers[-1])]
         if self.index is not None:
             strings += ["index={}".format(self.index)]
@@ -63,8 +157,15 @@ class Drive():
     def snapshots(self):
         """
         Return a list of snapshots that exists in the top layer qcow2 for this
-        drive. NOTE: This doesn't return snapshots that exist in lower layers
+        drive. NOTE: This doesn't return snapshots that exist in lower layers.
+        The list is cached until the layer stack changes or
+        invalidate_snapshots() is called
         """
-        lines = subprocess.check_output(
-            ["bash", "-c", "qemu-img snapshot -l {} | tail -n +3 | awk '{{print $2}}'".format(self.__layers[-1])]).decode().split("\n")
-        return lines
+        if self.__snapshots is None:
+            # --force-share lets this be queried while a running qemu holds the
+            # image lock
+            out = subprocess.check_output(
+                ["qemu-img", "info", "--output=json", "--force-share", self.__layers[-1]])
+            self.__snapshots = [s["name"]
+                                for s in json.loads(out).get("snapshots", [])]
+        return list(self.__snapshots)
@@ -7,32 +7,93 @@ fixture to pytest tests
 
 
 import os
+import ctypes
+import select
+import shutil
 import socket
+import struct
 import subprocess
 import tempfile
-from multiprocessing import Process
 import time
 import signal
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pexpect import fdpexpect
 import pexpect
 
-import backoff
-
 # import qmp
 
+from . import Monitor
 from . import Network
+from .Drive import Drive
+
+
+QEMU_STARTUP_TIMEOUT = 50
+MIGRATION_TIMEOUT = 600
 
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
 
-@backoff.on_predicate(backoff.constant,
-                      interval=1,
-                      max_time=5)
-def get_pid_of_qemu(pid_file):
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+class DirectoryWatch():
     """
-    Keeps trying to read a pidfile, and returns its contents
+    A small inotify wrapper, so that we can wake up as soon as qemu creates or
+    writes a file in a Machine's temporary directory rather than polling for it
     """
-    with open(pid_file, 'r') as f:
-        val = f.readline().strip()
-        return int(val) if val is not "" else None
+
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, path, mask=IN_CREATE | IN_MOVED_TO):
+        self.fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        if _libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, os.strerror(e), path)
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __names(self):
+        names = set()
+        try:
+            buf = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(buf):
+            _, _, _, length = self._EVENT.unpack_from(buf, offset)
+            offset += self._EVENT.size
+            names.add(buf[offset:offset + length].rstrip(b"\0"))
+            offset += length
+        return names
+
+    def wait_until(self, name, check, timeout):
+        """
+        Returns the result of check() once it is not None, calling it again
+        each time the file called name is touched in the watched directory
+        """
+        deadline = time.monotonic() + timeout
+        target = os.fsencode(name)
+        rv = check()
+        while rv is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Timed out waiting for {}".format(name))
+            r, _, _ = select.select([self.fd], [], [], remaining)
+            if r and target in self.__names():
+                rv = check()
+        return rv
 
 
 class Machine:
@@ -41,32 +102,78 @@ class Machine:
     qemu-system-x86_64 takes, but some more complex ones as python objects
     """
 
-    def __init__(self, cpus=1, mem=1024, drives=[], net=[], kernel=None, kernel_append=None, boot_order=None, extra_serials=0, ephemeral=True, qemu_command_line=[]):
-        self.net = net
+    def __init__(self, cpus=1, mem=1024, drives=None, net=None, kernel=None, kernel_append=None, boot_order=None, extra_serials=0, ephemeral=True, qemu_command_line=None, monitor_pexpect=False, ephemeral_overlay_via_monitor=False):
+        self.net = [] if net is None else net
         self.cpus = cpus
         self.mem = mem
-        self.drives = drives
+        self.drives = [] if drives is None else drives
         self.__bridges = []
+        self.__process = None
+        self.pid = None
         self.__qmp_socket = None
         self.__qmp_expect = None
         self.__qmp_sock_file = None
-        self.__tmp_dir = tempfile.mkdtemp()
+        # Created by start(), so that a Machine that's never started costs
+        # nothing on disk
+        self.__tmp_dir = None
         self.kernel = kernel
         self.kernel_append = kernel_append
         self.__boot_order = boot_order
         self.__num_extra_serials = extra_serials
         self.__serials = []
         self.ephemeral = ephemeral
-        self.qemu_command_line = qemu_command_line
+        self.qemu_command_line = [] if qemu_command_line is None else qemu_command_line
+        self.__external_snapshots = {}
+        # pexpect on the monitor is slower, but handy when debugging by hand
+        self.__monitor_pexpect = monitor_pexpect
+        # Have qemu create the ephemeral layers itself, rather than qemu-img
+        self.ephemeral_overlay_via_monitor = ephemeral_overlay_via_monitor
 
         for index in range(extra_serials + 1):
-            serial_object = {"socket_file": os.path.join(self.__tmp_dir, "serial_{}.sock".format(index)),
-                             "socket": None, "expect": None, "logfd": None, "logfile": os.path.join(self.__tmp_dir, "serial_{}.log".format(index))}
-            serial_object["logfd"] = open(serial_object["logfile"], mode='w')
+            serial_object = {"socket_file": None, "socket": None,
+                             "expect": None, "logfd": None, "logfile": None}
             self.__serials += [serial_object]
 
+    def __make_tmp_dir(self):
+        """
+        Creates the temporary directory that holds this Machine's sockets, logs
+        and disk layers, the first time it's needed
+        """
+        if self.__tmp_dir is not None:
+            return
+        self.__tmp_dir = tempfile.mkdtemp()
+        for index, serial_object in enumerate(self.__serials):
+            serial_object["socket_file"] = os.path.join(
+                self.__tmp_dir, "serial_{}.sock".format(index))
+            serial_object["logfile"] = os.path.join(
+                self.__tmp_dir, "serial_{}.log".format(index))
+
     def cleanup(self):
-        os.system("rm -rf {}".format(self.__tmp_dir))
+        """
+        Removes the temporary directory holding sockets, logs and disk layers.
+        Called by __exit__, but should be called manually after stop() if not
+        used in a 'with' block. The Machine and its Drives can be started
+        again afterwards, from a fresh directory
+        """
+        for serial_object in self.__serials:
+            if serial_object["logfd"] is not None:
+                serial_object["logfd"].close()
+                serial_object["logfd"] = None
+        if self.__tmp_dir is None:
+            return
+
+        # Drop the layers about to be deleted, which all sit above any that
+        # live elsewhere
+        for d in self.drives:
+            layers = d.layers
+            for index, layer in enumerate(layers):
+                if index > 0 and os.path.dirname(layer) == self.__tmp_dir:
+                    d.revert_to_layer(layers[index - 1])
+                    break
+        self.__external_snapshots = {}
+
+        shutil.rmtree(self.__tmp_dir, ignore_errors=True)
+        self.__tmp_dir = None
 
     @property
     def qmp_socket(self):
@@ -95,50 +202,149 @@ class Machine:
         # time.sleep(1)
 
         self.kill_qemu()
+        # Only the bridges start() got as far as creating
         for n in self.net:
-            print("Deleting bridge ", n.uid)
-            n.delete_bridge()
+            if n.name in self.__bridges:
+                print("Deleting bridge ", n.uid)
+                n.delete_bridge()
+        self.__bridges = []
 
+        self.__disconnect()
+
+    def __disconnect(self):
+        """
+        Closes the monitor and serial channels of a qemu that has gone away
+        """
         for serial_object in self.__serials:
+            if serial_object["expect"] is not None:
+                try:
+                    serial_object["expect"].close()
+                except OSError:
+                    pass
+                serial_object["expect"] = None
+
+        if self.__qmp_expect is not None:
             try:
-                serial_object["expect"].close()
+                self.__qmp_expect.close()
             except OSError:
                 pass
-            serial_object["expect"] = None
+            self.__qmp_expect = None
 
     def start(self):
         """
         Called on __enter__, or manually to start the VM and connect sockets
         """
+        self.__make_tmp_dir()
+        for index, d in enumerate(self.drives):
+            # Named so that the monitor can refer to each of them
+            if d.drive_id is None:
+                d.drive_id = "drive{}".format(index)
+
+        # Each drive only waits on its own qemu-img runs, so do them all at once
+        with ThreadPoolExecutor(max_workers=max(1, len(self.drives))) as ex:
+            list(ex.map(self.__prepare_drive, self.drives))
+
+        # Netlink calls are quick and share one socket, so these stay in order
+        for n in self.net:
+            br_name = n.create_bridge()
+            self.__bridges += [br_name]
+
+        if not (self.ephemeral and self.ephemeral_overlay_via_monitor):
+            return self.__launch()
+
+        # Held at -S until every drive is writing to its overlay, so the
+        # backing files are never touched
+        self.__launch(["-S"])
+        overlays, commands = self.__overlay_commands(
+            "drive_{}".format(uuid.uuid4().hex))
+        try:
+            rsp = self.monitor_command(*commands)
+            self.__add_overlays(overlays, rsp)
+        except Exception:
+            # Never let the guest run on a drive still writing to its backing file
+            self.stop()
+            raise
+        self.monitor_command("cont")
+        return self
+
+    def __prepare_drive(self, d):
+        """
+        Puts a drive's backing file back to its preboot snapshot, and adds a
+        temporary layer on top if this Machine is ephemeral.
+
+        If another running qemu has the backing file locked (e.g. other
+        ephemeral Machines or a MachinePool built from the same image), it
+        can't be reverted. For an ephemeral Machine that's fine: the other
+        qemus only read it through their own layers, so it's left as it is and
+        shared. Otherwise qemu would need to write to it directly, so
+        Drive.ImageLocked is raised
+        """
+        try:
+            # Applying fails if the snapshot isn't there yet, which saves
+            # asking qemu-img for the snapshot list first
+            try:
+                d.apply_snapshot("preboot")
+            except Drive.SnapshotNotFound:
+                d.create_snapshot("preboot")
+        except Drive.ImageLocked:
+            # Without a qemu-img layer, qemu opens the backing file for writing
+            if not self.ephemeral or self.ephemeral_overlay_via_monitor:
+                raise
+            print("Not reverting {} to preboot, it's in use by another qemu".format(
+                d.backing_file))
+        if self.ephemeral and not self.ephemeral_overlay_via_monitor:
+            d.create_disk_layer(self.__tmp_dir)
+
+    def __overlay_commands(self, prefix):
+        """
+        Returns paths for a new overlay on each drive, and the monitor commands
+        that have qemu create them and switch each drive over to writing there
+        """
+        overlays = [os.path.join(self.__tmp_dir, "{}_{}.qcow2".format(prefix, d.drive_id))
+                    for d in self.drives]
+        commands = ["snapshot_blkdev {} {} qcow2".format(d.drive_id, overlay)
+                    for d, overlay in zip(self.drives, overlays)]
+        return overlays, commands
+
+    def __add_overlays(self, overlays, responses):
+        """
+        Puts the overlays from __overlay_commands on top of each drive's stack,
+        given the monitor's response to each command. snapshot_blkdev prints
+        nothing when it succeeds. Raises RuntimeError naming the drives that
+        qemu didn't switch over, once the others have been added
+        """
+        failed = []
+        for d, overlay, rsp in zip(self.drives, overlays, responses):
+            errors = [line.strip() for line in rsp if line.strip()]
+            if len(errors) > 0 or not os.path.exists(overlay):
+                failed += ["{}: {}".format(d.drive_id,
+                                           " ".join(errors) or "no overlay created")]
+                continue
+            d.add_disk_layer(overlay)
+
+        if len(failed) > 0:
+            raise RuntimeError(
+                "qemu could not create overlays for {}".format("; ".join(failed)))
 
+    def __launch(self, extra_args=()):
+        """
+        Assembles the qemu command line from the current drive layers and
+        bridges, runs it, and connects to its monitor and serial sockets
+        """
         cpu_strings = ["-smp", str(self.cpus)]
 
         mem_strings = ["-m", str(self.mem)]
 
         drive_strings = []
         for d in self.drives:
-            if "preboot" in d.snapshots:
-                os.system(
-                    "qemu-img snapshot -a preboot {}".format(d.backing_file))
-            else:
-                os.system(
-                    "qemu-img snapshot -c preboot {}".format(d.backing_file))
-            if self.ephemeral:
-                d.create_disk_layer(self.__tmp_dir)
             drive_strings += ["-drive", d.to_drive_string()]
 
         net_strings = []
         for n in self.net:
-            br_name = n.create_bridge()
-            self.__bridges += [br_name]
-            # last 6 hex chars of mac_addr
-            br_id = n.mac_addr.replace(":", "")[-6:]
             net_strings += ["-netdev", "bridge,id={},br={}".format(
-                br_name, br_name), "-device", "e1000,netdev={},mac={}".format(br_name, n.mac_addr)]
+                n.name, n.name), "-device", "e1000,netdev={},mac={}".format(n.name, n.mac_addr)]
 
-        fd, self.pidfile = tempfile.mkstemp(
-            suffix=".pid", prefix="pidfile_", dir=self.__tmp_dir)
-        os.close(fd)
+        self.pidfile = os.path.join(self.__tmp_dir, "qemu.pid")
         pid_strings = ["-pidfile", self.pidfile]
 
         kernel_strings = []
@@ -170,11 +376,32 @@ class Machine:
                        *sockets_strings,
                        *boot_order_strings,
                        *kernel_strings,
-                       *self.qemu_command_line]
-        launch_string = " ".join(launch_args)
+                       *self.qemu_command_line,
+                       *extra_args]
+
+        # Sockets left behind by a previous start() would look ready already
+        sock_files = [self.__qmp_sock_file] + \
+            [serial_object["socket_file"] for serial_object in self.__serials]
+        for sock_file in sock_files:
+            if os.path.exists(sock_file):
+                os.unlink(sock_file)
+
+        # Watch before launching so nothing qemu creates can be missed
+        with DirectoryWatch(self.__tmp_dir) as watch:
+            # No shell in between, and a new session so that a SIGINT aimed at
+            # us doesn't take qemu down with it
+            self.__process = subprocess.Popen(
+                launch_args, close_fds=True, start_new_session=True)
+            self.pid = self.__process.pid
+            self.__connect(watch)
+
+        return self
 
-        self.__process = Process(target=os.system, args=(launch_string,))
-        self.__process.start()
+    def __connect(self, watch):
+        """
+        Connects to the monitor and serial sockets as soon as watch sees qemu
+        create them
+        """
 
         # XXX Qemu 2.5 (on ubuntu 16.04) doesn't support savevm/loadvm over qmp
         # @backoff.on_exception(backoff.constant,
@@ -187,27 +414,31 @@ class Machine:
         #     return s
         # self.__qmp_socket = get_qmp_socket(self.__qmp_sock_file)
 
-        self.__qmp_socket = get_serial_socket(self.__qmp_sock_file)
-        self.__qmp_expect = fdpexpect.fdspawn(
-            self.__qmp_socket, args=None, timeout=600, maxread=10240, encoding='utf-8')
+        self.__qmp_socket = get_serial_socket(self.__qmp_sock_file, watch)
         _path = os.path.join(self.__tmp_dir, "monitor.sock.log")
-        self.__qmp_expect.logfile = open(_path, mode='w')
+        if self.__monitor_pexpect:
+            self.__qmp_expect = fdpexpect.fdspawn(
+                self.__qmp_socket, args=None, timeout=600, maxread=10240, encoding='utf-8')
+            self.__qmp_expect.logfile = open(_path, mode='w')
+        else:
+            self.__qmp_expect = Monitor.MonitorChannel(
+                self.__qmp_socket, timeout=600, logfile=open(_path, mode='wb'))
         self.__qmp_expect.expect_exact("(qemu)")
 
         for serial_object in self.__serials:
             serial_object["socket"] = get_serial_socket(
-                serial_object["socket_file"])
+                serial_object["socket_file"], watch)
+            # Opened once the serial is actually connected; kept across
+            # restarts so the log covers the whole life of the Machine
+            if serial_object["logfd"] is None:
+                serial_object["logfd"] = open(serial_object["logfile"], mode='w')
             serial_object["expect"] = fdpexpect.fdspawn(
                 serial_object["socket"], args=None, timeout=600, maxread=10240, encoding='utf-8', logfile=serial_object["logfd"], searchwindowsize=10240)
 
-        self.pid = get_pid_of_qemu(self.pidfile)
-
-        return self
-
     def __enter__(self):
         """
         When used in a with block, assembles a command line to run, and runs it
-        in a multiprocessing call, providing control and serial sockets.
+        as a child process, providing control and serial sockets.
         """
         return self.start()
 
@@ -218,39 +449,117 @@ class Machine:
         """
         return snapshot_name in self.snapshots
 
-    @backoff.on_predicate(backoff.constant,
-                          interval=1,
-                          max_time=5)
-    def kill_qemu(self):
-        if os.path.exists("/proc/{}".format(self.pid)):
-            os.kill(self.pid, signal.SIGINT)
-            return False
+    def kill_qemu(self, timeout=5):
+        """
+        Sends a SIGINT to the qemu process, then waits on a pidfd for up to
+        timeout seconds for it to exit. Returns True if the process is gone
+        """
+        if self.__process is None:
+            return True
+
+        try:
+            fd = os.pidfd_open(self.pid)
+        except ProcessLookupError:
+            return True
+
+        try:
+            # Signalling through the pidfd can't hit a recycled pid
+            signal.pidfd_send_signal(fd, signal.SIGINT)
+            p = select.poll()
+            p.register(fd, select.POLLIN)
+            if len(p.poll(timeout * 1000)) == 0:
+                return False
+        except ProcessLookupError:
+            pass
+        finally:
+            os.close(fd)
+
+        # Reap it, after which the pid may belong to something else
+        self.__process.wait()
+        self.__process = None
         return True
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.stop()
-
-    def __del__(self):
         self.cleanup()
 
-    def take_snapshot(self, name):
+    def monitor_command(self, *commands):
         """
-        Wraps a "stop, savevm NAME, cont" set of commands to the qemu monitor
+        Sends one or more commands to the qemu monitor in a single write, then
+        waits for the prompt after each. The monitor runs them in order, so
+        there is no need to wait on each before sending the next. Returns a
+        list with the response lines of each command
         """
-        print("Taking snapshot:", name)
-        self.__qmp_expect.expect_exact(["(qemu)", pexpect.TIMEOUT], timeout=1)
-        self.__qmp_expect.sendline("stop")
-        self.__qmp_expect.expect_exact("(qemu)")
-        time.sleep(1)
-
-        self.__qmp_expect.sendline("savevm {}\n".format(name))
-        self.__qmp_expect.expect_exact("(qemu)")
-        time.sleep(1)
+        self.__qmp_expect.sendline("\n".join(commands))
+        rv = []
+        for _ in commands:
+            self.__qmp_expect.expect_exact("(qemu)")
+            # The first line is the echoed command
+            rv += [self.__qmp_expect.before.splitlines()[1:]]
+        return rv
 
-        self.__qmp_expect.sendline("cont")
-        self.__qmp_expect.expect_exact("(qemu)")
+    def take_snapshot(self, name, external=False):
+        """
+        Wraps a "stop, savevm NAME, cont" set of commands to the qemu monitor.
 
-        time.sleep(1)
+        With external=True, the disks are frozen by putting a new overlay on
+        top of each drive and the guest memory is migrated out to a file, rather
+        than copying everything into the top qcow2 with savevm. This takes time
+        proportional to the memory actually written out rather than blocking
+        in savevm, but needs qemu 2.8 or later
+        """
+        print("Taking snapshot:", name)
+        # Swallow any prompt already left over from commands sent outside this
+        # class, without waiting for one; monitor_command reads exactly one per
+        # command, so there's nothing to wait for after its own
+        self.__qmp_expect.expect_exact(["(qemu)", pexpect.TIMEOUT], timeout=0)
+        if not external:
+            self.monitor_command("stop", "savevm {}".format(name), "cont")
+            for d in self.drives:
+                d.invalidate_snapshots()
+            return
+
+        frozen = [d.layers[-1] for d in self.drives]
+        # Unique, as there may already be a snapshot by this name whose files
+        # are still in use
+        prefix = "{}_{}".format(name, uuid.uuid4().hex)
+        overlays, commands = self.__overlay_commands(prefix)
+        memory = os.path.join(self.__tmp_dir, "mem_{}".format(prefix))
+
+        rsp = self.monitor_command(
+            # The default migration bandwidth limit is far too low for a file
+            "migrate_set_parameter max-bandwidth 100G",
+            "stop",
+            *commands)
+        try:
+            self.__add_overlays(overlays, rsp[2:])
+            self.__save_memory(memory)
+        except Exception:
+            if os.path.exists(memory):
+                os.unlink(memory)
+            raise
+        finally:
+            self.monitor_command("cont")
+
+        # Like savevm, a new snapshot replaces an old one of the same name
+        old = self.__external_snapshots.get(name)
+        self.__external_snapshots[name] = {"memory": memory, "layers": frozen}
+        if old is not None:
+            os.unlink(old["memory"])
+
+    def __save_memory(self, memory):
+        """
+        Migrates the stopped guest out to the file memory. The monitor's migrate
+        only returns once the migration is over, so its status is final by the
+        time it's checked
+        """
+        rsp, info = self.monitor_command(
+            "migrate \"exec:cat > {}\"".format(memory), "info migrate")
+        errors = [line.strip() for line in rsp if line.strip()]
+        status = [line.strip() for line in info if line.startswith("Migration status:")]
+        if len(errors) > 0 or not any("completed" in line for line in status):
+            raise RuntimeError("Saving memory to {} failed: {}".format(
+                memory, " ".join(errors + status) or "no migration status"))
 
     class SnapshotNotFound(Exception):
         pass
@@ -262,8 +571,16 @@ class Machine:
         """
         print("Deleting snapshot:", name)
 
-        self.__qmp_expect.sendline("delvm {}".format(name))
-        self.__qmp_expect.expect_exact("(qemu)")
+        if name in self.__external_snapshots:
+            # The frozen layers are still backing the running drives, so only
+            # the memory image can go
+            snapshot = self.__external_snapshots.pop(name)
+            os.unlink(snapshot["memory"])
+            return
+
+        self.monitor_command("delvm {}".format(name))
+        for d in self.drives:
+            d.invalidate_snapshots()
 
         return
 
@@ -276,55 +593,108 @@ class Machine:
         # XXX Qemu 2.5 (on ubuntu 16.04) doesn't support savevm/loadvm over qmp
         # self.__qmp_socket.cmd("loadvm", args={"name": name})
         print("Going to snapshot:", name)
-        self.__qmp_expect.sendline("stop")
-        self.__qmp_expect.expect_exact("(qemu)")
+        if name in self.__external_snapshots:
+            return self.__goto_external_snapshot(name)
 
-        self.__qmp_expect.sendline("loadvm {}".format(name))
-        self.__qmp_expect.expect_exact("(qemu)")
-        rsp = self.__qmp_expect.before.splitlines()[1:]
+        # Leave the machine stopped if the snapshot can't be loaded
+        _, rsp = self.monitor_command("stop", "loadvm {}".format(name))
         if any(["does not have the requested snapshot" in r for r in rsp]):
             raise Machine.SnapshotNotFound
 
-        self.__qmp_expect.sendline("cont")
-        self.__qmp_expect.expect_exact("(qemu)")
+        self.monitor_command("cont")
 
         return
 
-    @property
-    def snapshots(self):
+    def __goto_external_snapshot(self, name):
         """
-        Return a list of snapshots that exists in the top layer qcow2 for this
-        drive. NOTE: This doesn't return snapshots that exist in lower layers
+        Restarts qemu on fresh overlays above the layers frozen by an external
+        snapshot, and loads its memory image back in with -incoming. The
+        bridges are left in place, so veth pairs to them survive
         """
-        self.__qmp_expect.sendline("info snapshots")
-        self.__qmp_expect.expect_exact("(qemu)")
-        rsp = self.__qmp_expect.before.splitlines()[1:]
+        snapshot = self.__external_snapshots[name]
+        for d, layer in zip(self.drives, snapshot["layers"]):
+            if layer not in d.layers:
+                raise Machine.SnapshotNotFound
+
+        # A second qemu on the same layers would corrupt them
+        if not self.kill_qemu():
+            raise RuntimeError(
+                "qemu {} did not exit, not loading snapshot {}".format(self.pid, name))
+        self.__disconnect()
+
+        for d, layer in zip(self.drives, snapshot["layers"]):
+            d.revert_to_layer(layer)
+            # Writing straight into the frozen layer would spoil the snapshot
+            d.create_disk_layer(self.__tmp_dir)
+
+        # Snapshots taken after this one were frozen in layers now discarded
+        for other, s in list(self.__external_snapshots.items()):
+            if any(layer not in d.layers for d, layer in zip(self.drives, s["layers"])):
+                os.unlink(s["memory"])
+                del self.__external_snapshots[other]
+
+        self.__launch(["-incoming", "exec:cat {}".format(snapshot["memory"])])
+        self.__finish_incoming(name)
 
-        rv = []
+        return
 
-        if "There is no snapshot available." in rsp:
-            return rv
+    def __finish_incoming(self, name, timeout=MIGRATION_TIMEOUT):
+        """
+        Waits for qemu to finish loading the memory of an external snapshot,
+        then resumes the guest. It was stopped when the snapshot was taken, so
+        qemu always brings it back paused. qemu exits if loading fails
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                [status] = self.monitor_command("info status")
+            except (pexpect.EOF, OSError):
+                raise RuntimeError(
+                    "qemu exited while loading snapshot {}".format(name)) from None
+            if not any("inmigrate" in line for line in status):
+                break
+            if time.monotonic() >= deadline:
+                raise TimeoutError(
+                    "Timed out loading snapshot {}".format(name))
+            time.sleep(0.05)
+
+        self.monitor_command("cont")
 
-        # Remove the "List of snapshots present on all disks:" line
-        rsp = rsp[1:]
+    @property
+    def snapshots(self):
+        """
+        Return a list of snapshots that exist in the top layer qcow2 of every
+        drive in this machine, followed by any external snapshots. Reads the
+        images directly rather than going through the monitor. NOTE: This
+        doesn't return snapshots that exist in lower layers
+        """
+        rv = []
+        if len(self.drives) > 0:
+            rv = self.drives[0].snapshots
+            for d in self.drives[1:]:
+                others = d.snapshots
+                rv = [s for s in rv if s in others]
 
-        for line in rsp:
-            if line.startswith("ID"):
-                continue
-            rv += [line.split()[1]]
-        return rv
+        return rv + [s for s in self.__external_snapshots if s not in rv]
 
 
-@backoff.on_exception(backoff.constant,
-                      Exception,
-                      interval=1,
-                      max_time=50)
-def get_serial_socket(sock_file):
+def get_serial_socket(sock_file, watch, timeout=QEMU_STARTUP_TIMEOUT):
     """
     Returns an open socket to communicate to a Machine's configured serial
-    port
+    port, waiting on watch for qemu to create it
     """
-    s = socket.socket(family=socket.AF_UNIX)
     print("Connecting to", sock_file)
-    s.connect(sock_file)
-    return s
+    deadline = time.monotonic() + timeout
+    watch.wait_until(os.path.basename(sock_file),
+                     lambda: os.path.exists(sock_file) or None, timeout)
+    while True:
+        s = socket.socket(family=socket.AF_UNIX)
+        try:
+            s.connect(sock_file)
+            return s
+        except ConnectionRefusedError:
+            # Bound but not listening yet
+            s.close()
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.01)
@@ -0,0 +1,128 @@
+"""
+A minimal reader for the qemu human monitor socket. It only does exact matches
+(which is all the monitor prompt needs), without the decoding and regex
+searching pexpect does on every read.
+"""
+
+import selectors
+import time
+
+import pexpect
+
+
+class MonitorChannel():
+    """
+    Wraps a connected monitor socket with the parts of the fdpexpect interface
+    that Machine uses: sendline(), expect_exact() and before. Input is read
+    straight into one reusable buffer and searched as bytes; only the text
+    before a match is decoded
+    """
+
+    def __init__(self, sock, timeout=30, bufsize=65536, logfile=None):
+        self.timeout = timeout
+        self.logfile = logfile
+        self.before = None
+        self.__sock = sock
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(sock, selectors.EVENT_READ)
+        self.__buf = bytearray(bufsize)
+        self.__view = memoryview(self.__buf)
+        self.__wpos = 0
+        # Everything before this offset has already been searched
+        self.__searched = 0
+
+    def sendline(self, s=""):
+        self.__sock.sendall((s + "\n").encode())
+
+    def __grow(self):
+        self.__view.release()
+        self.__buf.extend(bytes(len(self.__buf)))
+        self.__view = memoryview(self.__buf)
+
+    def __find(self, needles):
+        """
+        Returns (index into needles, offset) of the earliest needle in the
+        unsearched part of the buffer, or None
+        """
+        best = None
+        longest = max((len(n) for n in needles.values()), default=1)
+        start = max(0, self.__searched - longest + 1)
+        for i, needle in needles.items():
+            offset = self.__buf.find(needle, start, self.__wpos)
+            if offset >= 0 and (best is None or offset < best[1]):
+                best = (i, offset)
+        self.__searched = self.__wpos
+        return best
+
+    def __consume(self, offset, length):
+        """
+        Sets before to everything up to offset, and drops it and the match
+        from the buffer
+        """
+        self.before = self.__buf[:offset].decode("utf-8", errors="replace")
+        end = offset + length
+        rest = self.__wpos - end
+        self.__buf[:rest] = self.__buf[end:self.__wpos]
+        self.__wpos = rest
+        self.__searched = 0
+
+    def expect_exact(self, pattern_list, timeout=-1):
+        """
+        Waits for any of the strings in pattern_list and returns the index
+        of the one that arrived first. pexpect.TIMEOUT and pexpect.EOF may be
+        in the list too, otherwise they're raised
+        """
+        if not isinstance(pattern_list, list):
+            pattern_list = [pattern_list]
+        if timeout == -1:
+            timeout = self.timeout
+        # The previous call may have been after a different string, so
+        # anything already buffered has to be searched again
+        self.__searched = 0
+
+        needles = {}
+        for i, p in enumerate(pattern_list):
+            if isinstance(p, str):
+                needles[i] = p.encode()
+            elif isinstance(p, bytes):
+                needles[i] = p
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            found = self.__find(needles)
+            if found is not None:
+                i, offset = found
+                self.__consume(offset, len(needles[i]))
+                return i
+
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+            if not self.__selector.select(remaining):
+                self.before = self.__buf[:self.__wpos].decode(
+                    "utf-8", errors="replace")
+                if pexpect.TIMEOUT in pattern_list:
+                    return pattern_list.index(pexpect.TIMEOUT)
+                raise pexpect.TIMEOUT(
+                    "Timeout waiting for {}".format(pattern_list))
+
+            if self.__wpos == len(self.__buf):
+                self.__grow()
+            n = self.__sock.recv_into(self.__view[self.__wpos:])
+            if n == 0:
+                self.before = self.__buf[:self.__wpos].decode(
+                    "utf-8", errors="replace")
+                if pexpect.EOF in pattern_list:
+                    return pattern_list.index(pexpect.EOF)
+                raise pexpect.EOF("Monitor socket closed")
+            if self.logfile is not None:
+                self.logfile.write(self.__view[self.__wpos:self.__wpos + n])
+                self.logfile.flush()
+            self.__wpos += n
+
+    def close(self):
+        self.__selector.close()
+        self.__view.release()
+        self.__sock.close()
+        if self.logfile is not None:
+            self.logfile.close()
@@ -1,20 +1,89 @@
 """
-Wraps a bunch of calls to ip and brctl to help abstract connecting machines to
-each other, and to host bridges
+Wraps a bunch of netlink calls to help abstract connecting machines to each
+other, and to host bridges
 """
 
-import os
 import re
-from scapy.all import sniff
+import ctypes
+import itertools
+import socket
+import struct
+import time
 
 DHCP_SNIFF_TIMEOUT = 10
 
-bridge_counter = 0
-veth_counter = 0
+ETH_P_IP = 0x0800
+SO_ATTACH_FILTER = 26
+SOL_PACKET = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_MR_PROMISC = 1
+
+DHCPACK = 5
+DHCP_MAGIC_COOKIE = b"\x63\x82\x53\x63"
+
+_COLON_MAC = re.compile(r"^([0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2}$")
+_COMPACT_MAC = re.compile(r"^[0-9a-fA-F]{12}$")
+
+# next() on a count is atomic, so these are safe to share between threads.
+# Six digits keeps every generated name within IFNAMSIZ
+_bridge_ids = itertools.count()
+_veth_ids = itertools.count()
 
 # XXX FIXME: Rewrite all the inheritance here - it's a bit garbage
 
 
+class Netlink():
+    """
+    Holds a single IPRoute handle shared by every bridge and veth operation, so
+    links are managed over one netlink socket rather than a process per command
+    """
+
+    __ipr = None
+
+    @classmethod
+    def ipr(cls):
+        if cls.__ipr is None:
+            # pyroute2 is slow to import, so leave it until a link is touched
+            from pyroute2 import IPRoute
+            cls.__ipr = IPRoute()
+        return cls.__ipr
+
+    @classmethod
+    def index(cls, ifname):
+        return cls.ipr().link_lookup(ifname=ifname)[0]
+
+    @classmethod
+    def add_bridge(cls, ifname):
+        ipr = cls.ipr()
+        ipr.link("add", ifname=ifname, kind="bridge")
+        ipr.link("set", index=cls.index(ifname), state="up")
+
+    @classmethod
+    def delete_link(cls, ifname):
+        # Deleting a link takes it down too
+        cls.ipr().link("del", index=cls.index(ifname))
+
+    @classmethod
+    def delete_links(cls, ifnames):
+        """
+        Deletes several links, looking all of their indexes up with a single
+        dump rather than one request each
+        """
+        ipr = cls.ipr()
+        indexes = {link.get_attr("IFLA_IFNAME"): link["index"]
+                   for link in ipr.get_links()}
+        for ifname in ifnames:
+            ipr.link("del", index=indexes[ifname])
+
+    @classmethod
+    def add_veth_pair(cls, name1, master1, name2, master2):
+        ipr = cls.ipr()
+        ipr.link("add", ifname=name1, kind="veth", peer=name2)
+        for name, master in [(name1, master1), (name2, master2)]:
+            ipr.link("set", index=cls.index(name),
+                     master=cls.index(master), state="up")
+
+
 class Adapter():
     """
     Wraps a Bridge/Adapter link so that when QEmu creates a tapX device, we can
@@ -42,13 +111,11 @@ class Adapter():
         return self.__br_name
 
     def create_bridge(self):
-        os.system("brctl addbr {}".format(self.__br_name))
-        os.system("ip link set {} up".format(self.__br_name))
+        Netlink.add_bridge(self.__br_name)
         return self.__br_name
 
     def delete_bridge(self):
-        os.system("ip link set {} down".format(self.__br_name))
-        os.system("brctl delbr {}".format(self.__br_name))
+        Netlink.delete_link(self.__br_name)
 
 
 class Bridge():
@@ -58,9 +125,7 @@ class Bridge():
     """
 
     def __init__(self):
-        global bridge_counter
-        bridge_num = "{0:03d}".format(bridge_counter)
-        bridge_counter += 1
+        bridge_num = "{0:06d}".format(next(_bridge_ids))
 
         self.uid = bridge_num
         self.__br_name = "br-w{}".format(self.uid)
@@ -80,13 +145,11 @@ class Bridge():
         return self.__ip_address
 
     def create_bridge(self):
-        os.system("brctl addbr {}".format(self.name))
-        os.system("ip link set {} up".format(self.name))
+        Netlink.add_bridge(self.name)
         return self.name
 
     def delete_bridge(self):
-        os.system("ip link set {} down".format(self.name))
-        os.system("brctl delbr {}".format(self.name))
+        Netlink.delete_link(self.name)
 
     def delay(self, time=0, jitter=0):
         pass
@@ -104,44 +167,23 @@ class Bridge():
         bridge of the target Adapter and this one
         """
         # XXX FIXME Make this count better than just incrementing from zero
-        global veth_counter
-        name1 = "wveth{0:03d}".format(veth_counter)
-        veth_counter += 1
-        name2 = "wveth{0:03d}".format(veth_counter)
-        veth_counter += 1
-        for s in ["ip link add {} type veth peer name {}".format(name1, name2),
-                  "ip link set {} master {}".format(name1, self.name),
-                  "ip link set {} master {}".format(name2, adapter.name),
-                  "ip link set {} up".format(name1),
-                  "ip link set {} up".format(name2)
-                  ]:
-            print(s, flush=True)
-            os.system(s)
+        name1 = "wveth{0:06d}".format(next(_veth_ids))
+        name2 = "wveth{0:06d}".format(next(_veth_ids))
+        print("Adding veth pair {} ({}) <-> {} ({})".format(
+            name1, self.name, name2, adapter.name), flush=True)
+        Netlink.add_veth_pair(name1, self.name, name2, adapter.name)
 
         self.veth_pairs += [(name1, name2)]
 
         if wait_for_dhcp:
-            packets = sniff(count=1,
-                            store=True,
-                            offline=None,
-                            prn=None,
-                            lfilter=None,
-                            L2socket=None,
-                            timeout=dhcp_timeout,
-                            opened_socket=None,
-                            filter="udp and port 67 and ether dst {}".format(
-                                adapter.mac_addr),
-                            stop_filter=lambda packet: packet is not None and packet.getlayer(
-                                4) is not None and ("message-type", 5) in packet.getlayer(4).options,
-                            iface=self.name)
-
-            if len(packets) > 0:
+            new_ip_addr = sniff_dhcp_ack(self.name, adapter.mac_addr,
+                                         timeout=dhcp_timeout)
+
+            if new_ip_addr is not None:
                 print("Got DHCP packet on {}".format(self.name))
-                if packets[0].getlayer(3).yiaddr is not None:
-                    new_ip_addr = packets[0].getlayer(3).yiaddr
-                    print("Assigning {} to adapter with mac {}".format(
-                        new_ip_addr, adapter.mac_addr))
-                    adapter.ip_address = new_ip_addr
+                print("Assigning {} to adapter with mac {}".format(
+                    new_ip_addr, adapter.mac_addr))
+                adapter.ip_address = new_ip_addr
 
         return
 
@@ -151,19 +193,16 @@ class Bridge():
         should be called manually if not used in a 'with' block
         """
         for p1, p2 in self.veth_pairs:
-            for s in ["ip link set {} down".format(p1),
-                      "ip link set {} down".format(p2),
-                      "ip link delete {}".format(p1)]:
-                print(s)
-                os.system(s)
+            print("Deleting veth pair {} <-> {}".format(p1, p2))
+        # Deleting one end of a veth pair removes its peer as well
+        Netlink.delete_links([p1 for p1, _ in self.veth_pairs])
+        self.veth_pairs = []
 
 
 class Static(Bridge):
     def __init__(self):
-        global bridge_counter
         self.mac_addr = None
-        self.uid = "s-{0:03d}".format(bridge_counter)
-        bridge_counter += 1
+        self.uid = "s-{0:06d}".format(next(_bridge_ids))
         self.__br_name = "br-{}".format(self.uid)
         self.veth_pairs = []
         super().create_bridge()
@@ -177,14 +216,9 @@ class Static(Bridge):
         super().delete_bridge()
 
     def __enter__(self):
-        os.system("ip link add {} type bridge".format(self.name))
-        super().__enter__()
+        # The bridge was already created in __init__
         return self
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        super().__exit__(exc_type, exc_value, traceback)
-        os.system("ip link delete {}".format(self.name))
-
 
 class Host(Bridge):
     """
@@ -209,12 +243,112 @@ class Host(Bridge):
 
 def adapters_from_mac_list(mac_list):
     rv = []
-    colon_mac = re.compile("^([0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2}$")
-    compact_mac = re.compile("^[0-9a-fA-F]{12}$")
     for mac in mac_list:
-        if colon_mac.match(mac):
+        if _COLON_MAC.match(mac):
             rv.append(Adapter(mac.upper()))
-        elif compact_mac.match(mac):
-            splitmac = [mac[(2*b):(2*b)+2] for b in range(0, 6)]
-            rv.append(Adapter(":".join(splitmac)))
+        elif _COMPACT_MAC.match(mac):
+            rv.append(Adapter(":".join(mac[i:i + 2] for i in range(0, 12, 2))))
     return rv
+
+
+def dhcp_filter(mac_addr):
+    """
+    Assembles a classic BPF program matching unfragmented IPv4 UDP packets to or
+    from port 67 with an ethernet destination of mac_addr, so the kernel drops
+    everything else before it reaches us
+    """
+    mac = bytes.fromhex(mac_addr.replace(":", ""))
+    # (code, jump if true, jump if false, k), jumps are labels
+    program = [
+        (0x20, None, None, 0),          # ld [0]
+        (0x15, None, "drop", int.from_bytes(mac[:4], "big")),
+        (0x28, None, None, 4),          # ldh [4]
+        (0x15, None, "drop", int.from_bytes(mac[4:], "big")),
+        (0x28, None, None, 12),         # ldh [12]
+        (0x15, None, "drop", ETH_P_IP),
+        (0x30, None, None, 23),         # ldb [23]
+        (0x15, None, "drop", socket.IPPROTO_UDP),
+        (0x28, None, None, 20),         # ldh [20]
+        (0x45, "drop", None, 0x1fff),   # jset fragment offset
+        (0xb1, None, None, 14),         # ldxb 4*([14]&0xf)
+        (0x48, None, None, 14),         # ldh [x + 14]
+        (0x15, "accept", None, 67),
+        (0x48, None, None, 16),         # ldh [x + 16]
+        (0x15, "accept", "drop", 67),
+    ]
+    labels = {"accept": len(program), "drop": len(program) + 1}
+    program += [(0x06, None, None, 0x40000),  # accept: ret #262144
+                (0x06, None, None, 0)]        # drop: ret #0
+
+    def offset(pc, label):
+        return 0 if label is None else labels[label] - pc - 1
+
+    return b"".join(struct.pack("HBBI", code, offset(pc, jt), offset(pc, jf), k)
+                    for pc, (code, jt, jf, k) in enumerate(program))
+
+
+def parse_dhcp_ack(frame):
+    """
+    Returns the yiaddr of a DHCPACK carried in an ethernet frame matched by
+    dhcp_filter, or None if the frame holds any other kind of message
+    """
+    ihl = (frame[14] & 0x0f) * 4
+    dhcp = 14 + ihl + 8
+    options = dhcp + 240
+    if frame[dhcp + 236:options] != DHCP_MAGIC_COOKIE:
+        return None
+
+    i = options
+    while i + 1 < len(frame):
+        code = frame[i]
+        if code == 255:
+            break
+        if code == 0:
+            i += 1
+            continue
+        if code == 53 and i + 2 < len(frame):
+            if frame[i + 2] != DHCPACK:
+                return None
+            return socket.inet_ntoa(frame[dhcp + 16:dhcp + 20])
+        i += 2 + frame[i + 1]
+    return None
+
+
+def sniff_dhcp_ack(iface, mac_addr, timeout=DHCP_SNIFF_TIMEOUT):
+    """
+    Waits up to timeout seconds on iface for a DHCPACK sent to mac_addr, and
+    returns the address it assigns, or None if none was seen
+    """
+    bpf = ctypes.create_string_buffer(dhcp_filter(mac_addr))
+    fprog = struct.pack("HP", len(bpf.raw) // 8, ctypes.addressof(bpf))
+
+    # Nothing is queued on a packet socket until it's bound, so attaching the
+    # filter first means no unfiltered packets slip through
+    s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+        s.bind((iface, ETH_P_IP))
+        # Frames forwarded between other bridge ports only reach us in
+        # promiscuous mode, which is dropped again when the socket closes
+        mreq = struct.pack("iHH8s", socket.if_nametoindex(iface),
+                           PACKET_MR_PROMISC, 0, b"")
+        s.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP, mreq)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            s.settimeout(remaining)
+            try:
+                frame = s.recv(2048)
+            except socket.timeout:
+                return None
+            try:
+                ip_addr = parse_dhcp_ack(frame)
+            except IndexError:
+                continue
+            if ip_addr is not None:
+                return ip_addr
+    finally:
+        s.close()
@@ -0,0 +1,124 @@
+"""
+Keeps a number of Machines started and parked at a snapshot, so that tests can
+pick one up in the time it takes to load a snapshot rather than to boot qemu
+"""
+
+import queue
+import threading
+
+# Kept apart from the disk level "preboot" snapshot that Machine.start manages
+POOL_SNAPSHOT = "pool"
+
+
+class MachinePool():
+    """
+    Starts up to size Machines in a background thread and hands them out with
+    acquire(). factory is called with no arguments to make each new (not yet
+    started) Machine, and must give each one its own mac addresses so that
+    their bridges don't collide. Machines are parked, stopped, at a snapshot
+    taken just after qemu starts, and are sent back to it on acquire()
+    """
+
+    def __init__(self, factory, size=1, external=False):
+        self.factory = factory
+        self.size = size
+        self.external = external
+        self.__ready = queue.Queue()
+        self.__machines = []
+        self.__lock = threading.Lock()
+        self.__missing = threading.Semaphore(size)
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.__refill, daemon=True)
+        self.__thread.start()
+
+    def __refill(self):
+        """
+        Runs in the background, starting a new Machine whenever the pool is
+        short of one
+        """
+        while True:
+            self.__missing.acquire()
+            if self.__closed:
+                return
+            m = None
+            try:
+                m = self.factory()
+                m.start()
+                m.take_snapshot(POOL_SNAPSHOT, external=self.external)
+                m.monitor_command("stop")
+            except Exception as e:
+                if m is not None:
+                    self.__dispose(m)
+                # Handed to whoever is waiting in acquire()
+                self.__ready.put(e)
+                continue
+            with self.__lock:
+                self.__machines += [m]
+            self.__ready.put(m)
+
+    def acquire(self, timeout=None):
+        """
+        Returns a Machine from the pool, at the pool snapshot and running.
+        Raises queue.Empty if none is ready within timeout seconds
+        """
+        m = self.__ready.get(timeout=timeout)
+        if isinstance(m, Exception):
+            self.__missing.release()
+            raise m
+        try:
+            m.goto_snapshot(POOL_SNAPSHOT)
+        except Exception:
+            self.discard(m)
+            raise
+        return m
+
+    def release(self, m):
+        """
+        Hands a Machine back to the pool. It's parked until the next acquire()
+        sends it back to the pool snapshot. If it can't be paused it's thrown
+        away and replaced
+        """
+        try:
+            m.monitor_command("stop")
+        except Exception:
+            self.discard(m)
+            return
+        self.__ready.put(m)
+
+    def discard(self, m):
+        """
+        Stops a Machine taken from the pool for good, and has it replaced
+        """
+        with self.__lock:
+            self.__machines.remove(m)
+        self.__dispose(m)
+        self.__missing.release()
+
+    def __dispose(self, m):
+        """
+        Stops and cleans up a Machine, however far it got through starting
+        """
+        try:
+            m.stop()
+        except Exception as e:
+            print("Failed to stop pooled machine:", e)
+        m.cleanup()
+
+    def close(self):
+        """
+        Stops every Machine the pool has started, including any that are still
+        acquired
+        """
+        self.__closed = True
+        self.__missing.release()
+        self.__thread.join()
+        with self.__lock:
+            machines, self.__machines = self.__machines, []
+        for m in machines:
+            self.__dispose(m)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
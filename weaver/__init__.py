@@ -7,5 +7,7 @@ for pytest-based scenario tests.
 # Clickity click
 
 from . import Machine
+from . import Monitor
 from . import Network
 from . import Drive
+from . import Pool